@@ -32,14 +32,17 @@ Documentation at <http://pqdict.readthedocs.org/>.
 :license: MIT, see LICENSE for more details.
 
 """
+import heapq as _heapq
 from collections.abc import MutableMapping
-from operator import gt, lt
+from operator import gt, itemgetter, lt
 from typing import (
     Any,
     Callable,
     Dict,
+    ItemsView,
     Iterable,
     Iterator,
+    KeysView,
     List,
     Mapping,
     NamedTuple,
@@ -48,6 +51,7 @@ from typing import (
     Type,
     TypeVar,
     Union,
+    ValuesView,
 )
 
 __version__ = "1.4.0"
@@ -67,6 +71,7 @@ class Empty(KeyError):
 
 
 class Node(NamedTuple):
+    # Heap node of pqdict <= 1.4.0, kept only so that their pickles still load.
     key: Any
     value: Any
     prio: Any
@@ -82,133 +87,227 @@ class Node(NamedTuple):
 # http://algs4.cs.princeton.edu/24pq/. The way I like to think of it, an
 # item that is too "heavy" (low-priority) should sink down the tree, while
 # one that is too "light" should float or swim up.
+#
+# The heap is stored as two parallel lists, ``keys`` and ``prios``: a heap
+# node is the pair of entries found at the same position in both lists.
+# Comparisons index the priority keys directly instead of dereferencing a
+# node object first.
 
 
 def _sink(
-    heap: List[Node], position: Dict[Any, int], precedes: PrecedesFn, top: int = 0
+    keys: List[Any],
+    prios: List[Any],
+    position: Dict[Any, int],
+    precedes: PrecedesFn,
+    top: int = 0,
 ) -> None:
     # "Sink-to-the-bottom-then-swim" algorithm (Floyd, 1964)
     # Tends to reduce the number of comparisons when inserting "heavy"
     # items at the top, e.g. during a heap pop. See heapq for more details.
-    endpos = len(heap)
+    endpos = len(keys)
     # Grab the top node
     pos = top
-    node = heap[pos]
+    key = keys[pos]
+    prio = prios[pos]
     # Sift up a chain of child nodes
     child_pos = 2 * pos + 1
     while child_pos < endpos:
         # Choose the smaller child.
         other_pos = child_pos + 1
-        if other_pos < endpos and not precedes(
-            heap[child_pos].prio, heap[other_pos].prio
-        ):
+        if other_pos < endpos and not precedes(prios[child_pos], prios[other_pos]):
             child_pos = other_pos
-        child_node = heap[child_pos]
+        child_key = keys[child_pos]
         # Move it up one level.
-        heap[pos] = child_node
-        position[child_node.key] = pos
+        keys[pos] = child_key
+        prios[pos] = prios[child_pos]
+        position[child_key] = pos
         # Next level
         pos = child_pos
         child_pos = 2 * pos + 1
-    # We are left with a "vacant" leaf. Put our node there and let it swim
-    # until it reaches its new resting place.
-    heap[pos] = node
-    position[node.key] = pos
-    _swim(heap, position, precedes, pos, top)
+    # We are left with a "vacant" leaf. Let our node swim up from there
+    # until it reaches its new resting place. This is the loop in _swim,
+    # inlined to save a call per sink.
+    while pos > top:
+        parent_pos = (pos - 1) >> 1
+        parent_prio = prios[parent_pos]
+        if precedes(prio, parent_prio):
+            parent_key = keys[parent_pos]
+            keys[pos] = parent_key
+            prios[pos] = parent_prio
+            position[parent_key] = pos
+            pos = parent_pos
+            continue
+        break
+    # Put node in its new place
+    keys[pos] = key
+    prios[pos] = prio
+    position[key] = pos
 
 
 def _swim(
-    heap: List[Node],
+    keys: List[Any],
+    prios: List[Any],
     position: Dict[Any, int],
     precedes: PrecedesFn,
     pos: int,
     top: int = 0,
 ) -> None:
     # Grab the node from its place
-    node = heap[pos]
+    key = keys[pos]
+    prio = prios[pos]
     # Sift parents down until we find a place where the node fits.
     while pos > top:
         parent_pos = (pos - 1) >> 1
-        parent_node = heap[parent_pos]
-        if precedes(node.prio, parent_node.prio):
-            heap[pos] = parent_node
-            position[parent_node.key] = pos
+        parent_prio = prios[parent_pos]
+        if precedes(prio, parent_prio):
+            parent_key = keys[parent_pos]
+            keys[pos] = parent_key
+            prios[pos] = parent_prio
+            position[parent_key] = pos
             pos = parent_pos
             continue
         break
     # Put node in its new place
-    heap[pos] = node
-    position[node.key] = pos
+    keys[pos] = key
+    prios[pos] = prio
+    position[key] = pos
+
 
+# Priority key types whose == is consistent with <
+_HEAPQ_PRIO_TYPES = frozenset({int, float})
 
-def heapify(heap: List[Node], position: Dict[Any, int], precedes: PrecedesFn) -> None:
-    n = len(heap)
+
+def heapify(
+    keys: List[Any], prios: List[Any], position: Dict[Any, int], precedes: PrecedesFn
+) -> None:
+    n = len(keys)
+    if precedes is lt and _HEAPQ_PRIO_TYPES.issuperset(map(type, prios)):
+        # This is the ordering used by heapq, so we can hand the sifting over
+        # to its C implementation. Nodes are decorated with their current
+        # position to break ties without ever comparing keys. Comparing the
+        # decorated tuples tests priority keys with == before <, so this is
+        # only done for types whose == agrees with <.
+        nodes = list(zip(prios, range(n), keys))
+        _heapq.heapify(nodes)
+        prios[:] = map(itemgetter(0), nodes)
+        keys[:] = map(itemgetter(2), nodes)
+        position.update(zip(keys, range(n)))
+        return
     # No need to look at any leaf nodes.
     for pos in reversed(range(n // 2)):
-        _sink(heap, position, precedes, pos)
+        _sink(keys, prios, position, precedes, pos)
 
 
 def heaprepair(
-    heap: List[Node], position: Dict[Any, int], precedes: PrecedesFn, pos: int
+    keys: List[Any],
+    prios: List[Any],
+    position: Dict[Any, int],
+    precedes: PrecedesFn,
+    pos: int,
 ) -> None:
     # Repair the position of a modified node.
     # Bubble up or down depending on values of parent and children.
-    parent_pos = (pos - 1) >> 1
+    if pos and precedes(prios[pos], prios[(pos - 1) >> 1]):
+        _swim(keys, prios, position, precedes, pos)
+        return
+    endpos = len(keys)
     child_pos = 2 * pos + 1
-    if parent_pos > -1 and precedes(heap[pos].prio, heap[parent_pos].prio):
-        _swim(heap, position, precedes, pos)
-    elif child_pos < len(heap):
+    if child_pos < endpos:
         other_pos = child_pos + 1
-        if other_pos < len(heap) and not precedes(
-            heap[child_pos].prio, heap[other_pos].prio
-        ):
+        if other_pos < endpos and not precedes(prios[child_pos], prios[other_pos]):
             child_pos = other_pos
-        if precedes(heap[child_pos].prio, heap[pos].prio):
-            _sink(heap, position, precedes, pos)
+        if precedes(prios[child_pos], prios[pos]):
+            _sink(keys, prios, position, precedes, pos)
 
 
 def heappop(
-    heap: List[Node], position: Dict[Any, int], precedes: PrecedesFn, pos: int = 0
-) -> Node:
+    keys: List[Any],
+    prios: List[Any],
+    position: Dict[Any, int],
+    precedes: PrecedesFn,
+    pos: int = 0,
+) -> Any:
     # Take the very last node and place it in the vacated spot. Let it
     # sink or swim until it reaches its new resting place.
-    node_to_replace = heap[pos]
-    last = heap.pop()
-    if last is not node_to_replace:
-        heap[pos] = last
-        position[last.key] = pos
-        heaprepair(heap, position, precedes, pos)
-    del position[node_to_replace.key]
-    return node_to_replace
+    key_to_replace = keys[pos]
+    last_key = keys.pop()
+    last_prio = prios.pop()
+    if pos < len(keys):
+        keys[pos] = last_key
+        prios[pos] = last_prio
+        # Index the moved node right away, so that the index stays valid
+        # even if a comparison below raises.
+        position[last_key] = pos
+        if pos:
+            heaprepair(keys, prios, position, precedes, pos)
+        else:
+            # A leaf moved to the top can only sink.
+            _sink(keys, prios, position, precedes)
+    del position[key_to_replace]
+    return key_to_replace
 
 
 def heappush(
-    heap: List[Node], position: Dict[Any, int], precedes: PrecedesFn, node: Node
+    keys: List[Any],
+    prios: List[Any],
+    position: Dict[Any, int],
+    precedes: PrecedesFn,
+    key: Any,
+    prio: Any,
 ) -> None:
-    n = len(heap)
-    heap.append(node)
-    position[node.key] = n
-    _swim(heap, position, precedes, n)
+    n = len(keys)
+    keys.append(key)
+    prios.append(prio)
+    position[key] = n
+    _swim(keys, prios, position, precedes, n)
 
 
 def heapupdate(
-    heap: List[Node], position: Dict[Any, int], precedes: PrecedesFn, node: Node
+    keys: List[Any],
+    prios: List[Any],
+    position: Dict[Any, int],
+    precedes: PrecedesFn,
+    pos: int,
+    prio: Any,
 ) -> None:
-    pos = position[node.key]
-    heap[pos] = node
-    heaprepair(heap, position, precedes, pos)
+    prios[pos] = prio
+    heaprepair(keys, prios, position, precedes, pos)
 
 
 def heappushpop(
-    heap: List[Node], position: Dict[Any, int], precedes: PrecedesFn, node: Node
-) -> Node:
-    key = node.key
-    if heap and precedes(heap[0].prio, node.prio):
-        node, heap[0] = heap[0], node
-        position[key] = 0
-        del position[node.key]
-        _sink(heap, position, precedes, 0)
-    return node
+    keys: List[Any],
+    prios: List[Any],
+    position: Dict[Any, int],
+    precedes: PrecedesFn,
+    key: Any,
+    prio: Any,
+) -> Any:
+    if keys and precedes(prios[0], prio):
+        key, keys[0] = keys[0], key
+        prios[0] = prio
+        position[keys[0]] = 0
+        del position[key]
+        _sink(keys, prios, position, precedes, 0)
+    return key
+
+
+def heapreplace(
+    keys: List[Any],
+    prios: List[Any],
+    position: Dict[Any, int],
+    precedes: PrecedesFn,
+    key: Any,
+    prio: Any,
+) -> Any:
+    # Overwrite the top node and let the new one sink: a single descent,
+    # without shrinking and regrowing the heap as a pop and a push would.
+    top_key = keys[0]
+    del position[top_key]
+    keys[0] = key
+    prios[0] = prio
+    position[key] = 0
+    _sink(keys, prios, position, precedes, 0)
+    return top_key
 
 
 class pqdict(MutableMapping):
@@ -219,7 +318,9 @@ class pqdict(MutableMapping):
     and have their priorities updated by key.
     """
 
-    _heap: List[Node]
+    _keys: List[Any]
+    _prios: List[Any]
+    _values: Dict[Any, Any]
     _position: Dict[Any, int]
 
     def __init__(
@@ -275,8 +376,12 @@ class pqdict(MutableMapping):
         else:
             raise ValueError(f"`precedes` function must be a callable; got {precedes}")
 
-        # The heap
-        self._heap = []
+        # The heap: parallel lists of keys and priority keys
+        self._keys = []
+        self._prios = []
+
+        # The values
+        self._values = {}
 
         # The index
         self._position = {}
@@ -296,7 +401,8 @@ class pqdict(MutableMapping):
 
     def __repr__(self) -> str:
         """Return a string representation of the pqdict."""
-        things = ", ".join([f"{node.key}: {node.value}" for node in self._heap])
+        values = self._values
+        things = ", ".join([f"{key}: {values[key]}" for key in self._keys])
         return f"{self.__class__.__name__}({things})"
 
     @classmethod
@@ -327,24 +433,17 @@ class pqdict(MutableMapping):
     __marker: object = object()
     # __eq__ = MutableMapping.__eq__
     # __ne__ = MutableMapping.__ne__
-    # keys = MutableMapping.keys
-    # values = MutableMapping.values
-    # items = MutableMapping.items
-    # get = MutableMapping.get
-    # clear = MutableMapping.clear
-    # update = MutableMapping.update
-    # setdefault = MutableMapping.setdefault
 
     @classmethod
     def fromkeys(
         cls: Type[Tpqdict], iterable: Iterable, value: Any, **kwargs: Any
     ) -> Tpqdict:
         """Return a new pqdict mapping keys from an iterable to the same value."""
-        return cls(((k, value) for k in iterable), **kwargs)
+        return cls(dict.fromkeys(iterable, value), **kwargs)
 
     def __len__(self) -> int:
         """Return number of items in the pqdict."""
-        return len(self._heap)
+        return len(self._keys)
 
     def __contains__(self, key: Any) -> bool:
         """Return ``True`` if key is in the pqdict."""
@@ -356,44 +455,137 @@ class pqdict(MutableMapping):
         The order of iteration is arbitrary! Use ``popkeys`` to iterate over
         keys in priority order.
         """
-        for node in self._heap:
-            yield node.key
+        return iter(self._values)
+
+    def keys(self) -> KeysView[Any]:
+        """Return a view of the keys of the pqdict (in arbitrary order)."""
+        return self._values.keys()
+
+    def values(self) -> ValuesView[Any]:
+        """Return a view of the values of the pqdict (in arbitrary order)."""
+        return self._values.values()
+
+    def items(self) -> ItemsView[Any, Any]:
+        """Return a view of the items of the pqdict (in arbitrary order)."""
+        return self._values.items()
 
     def __getitem__(self, key: Any) -> Any:
         """Return the priority value of ``key``.
 
         Raises a ``KeyError`` if not in the pqdict.
         """
-        return self._heap[self._position[key]].value  # raises KeyError
+        return self._values[key]  # raises KeyError
+
+    def get(self, key: Any, default: Any = None) -> Any:
+        """Return the priority value of ``key``, or ``default`` if not present."""
+        return self._values.get(key, default)
 
     def __setitem__(self, key: Any, value: Any) -> None:
         """Assign a priority value to ``key``.
 
         If ``key`` is already in the pqdict, its priority value is updated.
         """
-        prio = self._keyfn(value) if self._keyfn else value
-        node = Node(key, value, prio)
-        if key in self._position:
-            heapupdate(self._heap, self._position, self._precedes, node)
+        keyfn = self._keyfn
+        position = self._position
+        prio = keyfn(value) if keyfn else value
+        self._values[key] = value
+        pos = position.get(key)
+        if pos is None:
+            heappush(self._keys, self._prios, position, self._precedes, key, prio)
         else:
-            heappush(self._heap, self._position, self._precedes, node)
+            heapupdate(self._keys, self._prios, position, self._precedes, pos, prio)
 
     def __delitem__(self, key: Any) -> None:
         """Remove item.
 
         Raises a ``KeyError`` if key is not in the pqdict.
         """
-        if key not in self._position:
-            raise KeyError(key)
-        heappop(self._heap, self._position, self._precedes, self._position[key])
+        pos = self._position[key]  # raises KeyError
+        heappop(self._keys, self._prios, self._position, self._precedes, pos)
+        del self._values[key]
+
+    def clear(self) -> None:
+        """Remove all items from the pqdict."""
+        self._keys.clear()
+        self._prios.clear()
+        self._values.clear()
+        self._position.clear()
+
+    def setdefault(self, key: Any, default: Any = None) -> Any:
+        """Return the priority value of ``key``, inserting ``default`` if absent."""
+        values = self._values
+        if key in values:
+            return values[key]
+        if type(self).__setitem__ is not pqdict.__setitem__:
+            self[key] = default
+            return default
+        keyfn = self._keyfn
+        prio = keyfn(default) if keyfn else default
+        values[key] = default
+        heappush(self._keys, self._prios, self._position, self._precedes, key, prio)
+        return default
+
+    def update(self, *args: Any, **kwargs: Any) -> None:
+        """Update the pqdict from a mapping or an iterable of pairs, or kwargs.
+
+        Existing keys have their priority values updated and new keys are
+        added. Large batches are written in bulk and repaired with a single
+        linear-time heapify instead of being assigned one by one. Subclasses
+        that override ``__setitem__`` always get one assignment per item.
+        """
+        if type(self).__setitem__ is not pqdict.__setitem__:
+            MutableMapping.update(self, *args, **kwargs)
+            return
+        items = dict(*args, **kwargs)
+        keys = self._keys
+        size = len(keys) + len(items)
+        # k individual assignments cost O(k log n), a rebuild costs O(n).
+        if len(items) * size.bit_length() <= size:
+            for key, value in items.items():
+                self[key] = value
+            return
+        # Compute all the priority keys before touching the heap, so that a
+        # failing key function leaves the pqdict unchanged.
+        keyfn = self._keyfn
+        if keyfn is None:
+            new_prios = list(items.values())
+        else:
+            new_prios = list(map(keyfn, items.values()))
+        prios = self._prios
+        values = self._values
+        position = self._position
+        values.update(items)
+        for key, prio in zip(items, new_prios):
+            pos = position.get(key)
+            if pos is None:
+                position[key] = len(keys)
+                keys.append(key)
+                prios.append(prio)
+            else:
+                prios[pos] = prio
+        heapify(keys, prios, position, self._precedes)
 
     def copy(self: Tpqdict) -> Tpqdict:
         """Return a shallow copy of a pqdict."""
         other = self.__class__(key=self._keyfn, precedes=self._precedes)
         other._position = self._position.copy()
-        other._heap = self._heap[:]
+        other._values = self._values.copy()
+        other._keys = self._keys[:]
+        other._prios = self._prios[:]
         return other
 
+    __copy__ = copy
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """Restore a pickled pqdict, including those pickled by pqdict 1.4.0."""
+        heap = state.pop("_heap", None)
+        if heap is not None:
+            # Migrate the heap of Node objects used up to 1.4.0.
+            state["_keys"] = [node.key for node in heap]
+            state["_prios"] = [node.prio for node in heap]
+            state["_values"] = {node.key: node.value for node in heap}
+        self.__dict__.update(state)
+
     def pop(
         self,
         key: Any = __marker,
@@ -414,19 +606,23 @@ class pqdict(MutableMapping):
         * If the pqdict is empty, return ``default`` if provided, otherwise
           raise ``Empty``.
         """
+        keys = self._keys
+        position = self._position
         # pq semantics: remove and return top *key* (value is discarded)
         if key is self.__marker:
-            if self._heap:
-                return heappop(self._heap, self._position, self._precedes).key
+            if keys:
+                key = heappop(keys, self._prios, position, self._precedes)
+                del self._values[key]
+                return key
             elif default is self.__marker:
                 raise Empty("pqdict is empty")
             else:
                 return default
         # dict semantics: remove and return *value* mapped from key
-        elif key in self._position:
-            return heappop(
-                self._heap, self._position, self._precedes, self._position[key]
-            ).value
+        pos = position.get(key)
+        if pos is not None:
+            heappop(keys, self._prios, position, self._precedes, pos)
+            return self._values.pop(key)
         elif default is self.__marker:
             raise KeyError(key)
         else:
@@ -441,8 +637,8 @@ class pqdict(MutableMapping):
         If ``default`` is provided and pqdict is empty, then return ``default``,
         otherwise raise ``Empty``.
         """
-        if self._heap:
-            return self._heap[0].key
+        if self._keys:
+            return self._keys[0]
         elif default is self.__marker:
             raise Empty("pqdict is empty")
         else:
@@ -454,8 +650,8 @@ class pqdict(MutableMapping):
         If ``default`` is provided and pqdict is empty, then return ``default``,
         otherwise raise ``Empty``.
         """
-        if self._heap:
-            return self._heap[0].value
+        if self._keys:
+            return self._values[self._keys[0]]
         elif default is self.__marker:
             raise Empty("pqdict is empty")
         else:
@@ -466,9 +662,9 @@ class pqdict(MutableMapping):
 
         Raises ``Empty`` if pqdict is empty.
         """
-        if self._heap:
-            node = self._heap[0]
-            return node.key, node.value
+        if self._keys:
+            key = self._keys[0]
+            return key, self._values[key]
         elif default is self.__marker:
             raise Empty("pqdict is empty")
         else:
@@ -480,8 +676,10 @@ class pqdict(MutableMapping):
         If ``default`` is provided and pqdict is empty, then return ``default``,
         otherwise raise ``Empty``.
         """
-        if self._heap:
-            return heappop(self._heap, self._position, self._precedes).value
+        keys = self._keys
+        if keys:
+            key = heappop(keys, self._prios, self._position, self._precedes)
+            return self._values.pop(key)
         elif default is self.__marker:
             raise Empty("pqdict is empty")
         else:
@@ -492,9 +690,10 @@ class pqdict(MutableMapping):
 
         Raises ``Empty`` if pqdict is empty.
         """
-        if self._heap:
-            node = heappop(self._heap, self._position, self._precedes)
-            return node.key, node.value
+        keys = self._keys
+        if keys:
+            key = heappop(keys, self._prios, self._position, self._precedes)
+            return key, self._values.pop(key)
         elif default is self.__marker:
             raise Empty("pqdict is empty")
         else:
@@ -505,22 +704,25 @@ class pqdict(MutableMapping):
 
         Raises ``KeyError`` if key is already in the pqdict.
         """
-        if key in self._position:
+        position = self._position
+        if key in position:
             raise KeyError(f"{key} is already in the queue")
-        prio = self._keyfn(value) if self._keyfn else value
-        node = Node(key, value, prio)
-        heappush(self._heap, self._position, self._precedes, node)
+        keyfn = self._keyfn
+        prio = keyfn(value) if keyfn else value
+        self._values[key] = value
+        heappush(self._keys, self._prios, position, self._precedes, key, prio)
 
     def updateitem(self, key: Any, new_val: Any) -> None:
         """Update the priority value of an existing item.
 
         Raises ``KeyError`` if key is not in the pqdict.
         """
-        if key not in self._position:
-            raise KeyError(key)
-        prio = self._keyfn(new_val) if self._keyfn else new_val
-        node = Node(key, new_val, prio)
-        heapupdate(self._heap, self._position, self._precedes, node)
+        position = self._position
+        pos = position[key]  # raises KeyError
+        keyfn = self._keyfn
+        prio = keyfn(new_val) if keyfn else new_val
+        self._values[key] = new_val
+        heapupdate(self._keys, self._prios, position, self._precedes, pos, prio)
 
     def pushpopitem(self, key: Any, value: Any) -> Tuple[Any, Any]:
         """Insert a new item and return the top-priority item.
@@ -529,13 +731,41 @@ class pqdict(MutableMapping):
         priority item, but faster. Raises ``KeyError`` if the new key is
         already in the pqdict.
         """
-        if key in self._position:
+        position = self._position
+        if key in position:
             raise KeyError(f"{key} is already in the queue")
-        prio = self._keyfn(value) if self._keyfn else value
-        node = heappushpop(
-            self._heap, self._position, self._precedes, Node(key, value, prio)
+        keyfn = self._keyfn
+        prio = keyfn(value) if keyfn else value
+        top_key = heappushpop(
+            self._keys, self._prios, position, self._precedes, key, prio
         )
-        return node.key, node.value
+        if top_key is key:
+            return key, value
+        values = self._values
+        values[key] = value
+        return top_key, values.pop(top_key)
+
+    def replaceitem(self, key: Any, value: Any) -> Tuple[Any, Any]:
+        """Remove and return the top-priority item and insert a new item.
+
+        Equivalent to removing the top priority item followed by inserting a
+        new item, but faster. Raises ``Empty`` if pqdict is empty, or
+        ``KeyError`` if the new key is already in the pqdict and is not the
+        top-priority key.
+        """
+        keys = self._keys
+        if not keys:
+            raise Empty("pqdict is empty")
+        position = self._position
+        if position.get(key, 0) != 0:
+            raise KeyError(f"{key} is already in the queue")
+        keyfn = self._keyfn
+        prio = keyfn(value) if keyfn else value
+        top_key = heapreplace(keys, self._prios, position, self._precedes, key, prio)
+        values = self._values
+        top_value = values.pop(top_key)
+        values[key] = value
+        return top_key, top_value
 
     def replace_key(self, key: Any, new_key: Any) -> None:
         """Replace the key of an existing heap node in place.
@@ -547,49 +777,50 @@ class pqdict(MutableMapping):
             raise KeyError(f"{new_key} is already in the queue")
         pos = self._position.pop(key)  # raises appropriate KeyError
         self._position[new_key] = pos
-        node = self._heap[pos]
-        self._heap[pos] = Node(new_key, node.value, node.prio)
+        self._keys[pos] = new_key
+        self._values[new_key] = self._values.pop(key)
 
     def swap_priority(self, key1: Any, key2: Any) -> None:
         """Fast way to swap the priority level of two items in the pqdict.
 
         Raises ``KeyError`` if either key does not exist.
         """
-        heap = self._heap
+        keys = self._keys
+        values = self._values
         position = self._position
         if key1 not in position:
             raise KeyError(key1)
         if key2 not in position:
             raise KeyError(key2)
         pos1, pos2 = position[key1], position[key2]
-        node1, node2 = heap[pos1], heap[pos2]
-        heap[pos1] = Node(key2, node1.value, node1.prio)
-        heap[pos2] = Node(key1, node2.value, node2.prio)
+        keys[pos1], keys[pos2] = key2, key1
+        values[key1], values[key2] = values[key2], values[key1]
         position[key1], position[key2] = pos2, pos1
 
     def popkeys(self) -> Iterator[Any]:
         """Remove items, returning keys in descending order of priority rank."""
-        try:
-            while True:
-                yield self.pop()
-        except Empty:
-            return
+        keys, prios, values = self._keys, self._prios, self._values
+        position, precedes = self._position, self._precedes
+        while keys:
+            key = heappop(keys, prios, position, precedes)
+            del values[key]
+            yield key
 
     def popvalues(self) -> Iterator[Any]:
         """Remove items, returning values in descending order of priority rank."""
-        try:
-            while True:
-                yield self.popvalue()
-        except Empty:
-            return
+        keys, prios, values = self._keys, self._prios, self._values
+        position, precedes = self._position, self._precedes
+        while keys:
+            key = heappop(keys, prios, position, precedes)
+            yield values.pop(key)
 
     def popitems(self) -> Iterator[Tuple[Any, Any]]:
         """Remove and return items in descending order of priority rank."""
-        try:
-            while True:
-                yield self.popitem()
-        except Empty:
-            return
+        keys, prios, values = self._keys, self._prios, self._values
+        position, precedes = self._position, self._precedes
+        while keys:
+            key = heappop(keys, prios, position, precedes)
+            yield key, values.pop(key)
 
     def heapify(self, key: Any = __marker) -> None:
         """Repair a broken heap.
@@ -598,11 +829,10 @@ class pqdict(MutableMapping):
         provide ``key`` to repair the heap by relocating that item.
         """
         if key is self.__marker:
-            heapify(self._heap, self._position, self._precedes)
+            heapify(self._keys, self._prios, self._position, self._precedes)
         else:
-            if key not in self._position:
-                raise KeyError(key)
-            heaprepair(self._heap, self._position, self._precedes, self._position[key])
+            pos = self._position[key]  # raises KeyError
+            heaprepair(self._keys, self._prios, self._position, self._precedes, pos)
 
 
 #############
@@ -610,6 +840,13 @@ class pqdict(MutableMapping):
 #############
 
 
+def _item_prio(key: Optional[PrioKeyFn]) -> Callable[[Tuple[Any, Any]], Any]:
+    # Priority key of a (key, value) item
+    if key is None:
+        return itemgetter(1)
+    return lambda item: key(item[1])
+
+
 def nlargest(n: int, mapping: Mapping, key: Optional[PrioKeyFn] = None):
     """Return the n keys associated with the largest values in a mapping.
 
@@ -639,21 +876,8 @@ def nlargest(n: int, mapping: Mapping, key: Optional[PrioKeyFn] = None):
     >>> [item[0] for item in heapq.nlargest(n, mapping.items(), lambda x: x[1])]
 
     """
-    it = iter(mapping.items())
-    pq = pqdict(key=key, precedes=lt)
-    try:
-        for _ in range(n):
-            pq.additem(*next(it))
-    except StopIteration:
-        pass
-    try:
-        while it:
-            pq.pushpopitem(*next(it))
-    except StopIteration:
-        pass
-    out = list(pq.popkeys())
-    out.reverse()
-    return out
+    items = mapping.items()
+    return [item[0] for item in _heapq.nlargest(n, items, key=_item_prio(key))]
 
 
 def nsmallest(n: int, mapping: Mapping, key: Optional[PrioKeyFn] = None):
@@ -685,18 +909,5 @@ def nsmallest(n: int, mapping: Mapping, key: Optional[PrioKeyFn] = None):
     >>> [item[0] for item in heapq.nsmallest(n, mapping.items(), lambda x: x[1])]
 
     """
-    it = iter(mapping.items())
-    pq = pqdict(key=key, precedes=gt)
-    try:
-        for _ in range(n):
-            pq.additem(*next(it))
-    except StopIteration:
-        pass
-    try:
-        while it:
-            pq.pushpopitem(*next(it))
-    except StopIteration:
-        pass
-    out = list(pq.popkeys())
-    out.reverse()
-    return out
+    items = mapping.items()
+    return [item[0] for item in _heapq.nsmallest(n, items, key=_item_prio(key))]
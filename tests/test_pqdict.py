@@ -1,6 +1,10 @@
+import copy
+import functools
 import operator
+import pickle
 import random
 import sys
+import weakref
 from datetime import datetime, timedelta
 from itertools import combinations
 
@@ -40,22 +44,24 @@ def generate_data(value_type, num_items=None):
 
 
 def _check_heap_invariant(pq):
-    heap = pq._heap
-    for pos, node in enumerate(heap):
+    prios = pq._prios
+    for pos, prio in enumerate(prios):
         if pos:  # pos 0 has no parent
             parentpos = (pos - 1) >> 1
-            assert heap[parentpos].value <= node.value
+            assert prios[parentpos] <= prio
 
 
 def _check_index(pq):
     # All heap entries are pointed to by the index (_position)
-    n = len(pq._heap)
-    nodes = pq._position.values()
-    assert list(range(n)) == sorted(nodes)
+    n = len(pq._keys)
+    assert len(pq._prios) == n
+    positions = pq._position.values()
+    assert list(range(n)) == sorted(positions)
     # All heap entries map back to the correct dictionary key
     for key in pq._position:
-        node = pq._heap[pq._position[key]]
-        assert key == node.key
+        assert key == pq._keys[pq._position[key]]
+        assert key in pq._values
+    assert len(pq._values) == n
 
 
 ##########
@@ -75,6 +81,18 @@ def test_constructor():
     assert pq0 == pq1 == pq2 == pq3
 
 
+def test_constructor_duplicates():
+    # later values win, as with dict
+    pq = pqdict([("A", 5), ("B", 8), ("A", 1), ("C", 7)])
+    assert len(pq) == 3
+    assert pq["A"] == 1
+    assert pq.top() == "A"
+    _check_index(pq)
+    pq = pqdict([("A", (0, 5)), ("B", (1, 3)), ("A", (2, 9))], key=lambda x: x[1])
+    assert pq["A"] == (2, 9)
+    assert list(pq.popkeys()) == ["B", "A"]
+
+
 def test_equality():
     # eq
     pq1 = pqdict(sample_items)
@@ -164,6 +182,18 @@ def test_setitem():
     assert len(pq) == n + 1
 
 
+def test_setitem_incomparable():
+    # A failed comparison must leave the new key indexed
+    pq = pqdict({"a": 1})
+    with pytest.raises(TypeError):
+        pq["x"] = None
+    assert "x" in pq
+    _check_index(pq)
+    del pq["x"]
+    assert "x" not in pq
+    _check_index(pq)
+
+
 def test_delitem():
     n = len(sample_items)
     pq = pqdict(sample_items)
@@ -183,15 +213,22 @@ def test_copy():
     pq2[key] += 1
     assert pq1[key] != pq2[key]
     assert pq1 != pq2
+    # copy module
+    pq3 = copy.copy(pq1)
+    assert pq1 == pq3
+    pq3[key] += 1
+    assert pq1[key] != pq3[key]
+    _check_index(pq1)
+    _check_index(pq3)
 
 
-# inherited implementations
 def test_get():
     pq = pqdict(sample_items)
     assert pq.get("A") == 5
     assert pq.get("A", None) == 5
     assert pq.get("does_not_exist", None) is None
     assert pq.get('does_not_exist') is None
+    assert pq.get("does_not_exist", 99) == 99
 
 
 def test_clear():
@@ -199,6 +236,10 @@ def test_clear():
     pq.clear()
     assert len(pq) == 0
     _check_index(pq)
+    pq["A"] = 5
+    pq["B"] = 1
+    assert pq.popitem() == ("B", 1)
+    _check_index(pq)
 
 
 def test_setdefault():
@@ -206,6 +247,11 @@ def test_setdefault():
     assert pq.setdefault("A", 99) == 5
     assert pq.setdefault("new", 99) == 99
     assert pq["new"] == 99
+    _check_index(pq)
+    pq = pqdict.minpq(A=5)
+    assert pq.setdefault("B", 1) == 1
+    assert pq.top() == "B"
+    _check_index(pq)
 
 
 def test_update():
@@ -219,6 +265,63 @@ def test_update():
     assert pq1["D"] == 4000
     assert "XYZ" in pq1
     assert pq1["XYZ"] == 9000
+    pq1.update([("A", -1)], E=-2)
+    assert pq1["A"] == -1
+    assert pq1.top() == "E"
+
+
+def test_update_bulk():
+    for size in (1, 2, 10, 100):
+        for num_updates in (1, 5, 50, 200):
+            items = generate_data("int")
+            pq = pqdict(items[:size], reverse=True)
+            pq.update((key, -value) for key, value in items[:num_updates])
+            expected = dict(items[:size])
+            expected.update((key, -value) for key, value in items[:num_updates])
+            assert pq == expected
+            _check_index(pq)
+            values = list(pq.popvalues())
+            assert values == sorted(values, reverse=True)
+
+
+def test_update_bulk_failing_key():
+    def key(value):
+        if value == 3:
+            raise ValueError(value)
+        return -value
+
+    pq = pqdict(enumerate(range(3)), key=key)
+    before = dict(pq)
+    with pytest.raises(ValueError):
+        pq.update((i, i + 1) for i in range(4))
+    assert pq == before
+    _check_index(pq)
+    assert list(pq.popvalues()) == [2, 1, 0]
+
+
+def test_update_subclass_setitem():
+    class LoggingPQ(pqdict):
+        def __init__(self, *args, **kwargs):
+            self.log = []
+            super().__init__(*args, **kwargs)
+
+        def __setitem__(self, key, value):
+            self.log.append(key)
+            super().__setitem__(key, value)
+
+    pq = LoggingPQ({"a": 1, "b": 2})
+    assert pq.log == ["a", "b"]
+    pq = LoggingPQ()
+    pq.update((i, -i) for i in range(100))
+    assert pq.log == list(range(100))
+    _check_index(pq)
+    pq = LoggingPQ()
+    pq.update([("a", 1), ("a", 2)], b=3)
+    assert pq.log == ["a", "a", "b"]
+    assert pq["a"] == 2
+    assert pq.setdefault("a", 0) == 2
+    assert pq.setdefault("c", 4) == 4
+    assert pq.log == ["a", "a", "b", "c"]
 
 
 def test_iter():
@@ -246,9 +349,95 @@ def test_values():
 def test_items():
     pq = pqdict(sample_items)
     assert sorted(sample_items) == sorted(pq.items())
+    assert list(pq.items()) == list(zip(pq.keys(), pq.values()))
+    assert list(pq.keys()) == list(iter(pq))
     assert sorted(sample_values) == [item[1] for item in pq.popitems()]
 
 
+def test_weakref_and_attributes():
+    pq = pqdict(sample_items)
+    ref = weakref.ref(pq)
+    assert ref() is pq
+    pq.name = "queue"
+    assert pq.name == "queue"
+
+
+def test_pickle():
+    for precedes in (operator.lt, operator.gt):
+        pq = pqdict(sample_items, precedes=precedes)
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            pq2 = pickle.loads(pickle.dumps(pq, protocol))
+            assert pq2 == pq
+            assert pq2.precedes is precedes
+            _check_index(pq2)
+            assert list(pq2.popitems()) == list(pq.copy().popitems())
+
+
+def test_pickle_legacy():
+    # pqdict({"a": 3, "b": 1, "c": 2}) pickled by pqdict 1.4.0 (protocols 0, 4)
+    legacy = [
+        b"ccopy_reg\n_reconstructor\np0\n(cpqdict\npqdict\np1\nc__builtin__\n"
+        b"object\np2\nNtp3\nRp4\n(dp5\nV_keyfn\np6\nNsV_precedes\np7\n"
+        b"c_operator\nlt\np8\nsV_heap\np9\n(lp10\ng0\n(cpqdict\nNode\np11\n"
+        b"c__builtin__\ntuple\np12\n(Vb\np13\nI1\nI1\ntp14\ntp15\nRp16\nag0\n"
+        b"(g11\ng12\n(Va\np17\nI3\nI3\ntp18\ntp19\nRp20\nag0\n(g11\ng12\n"
+        b"(Vc\np21\nI2\nI2\ntp22\ntp23\nRp24\nasV_position\np25\n(dp26\n"
+        b"g17\nI1\nsg13\nI0\nsg21\nI2\nssb.",
+        b"\x80\x04\x95\x9a\x00\x00\x00\x00\x00\x00\x00\x8c\x06pqdict\x94h\x00"
+        b"\x93\x94)\x81\x94}\x94(\x8c\x06_keyfn\x94N\x8c\t_precedes\x94\x8c\t"
+        b"_operator\x94\x8c\x02lt\x94\x93\x94\x8c\x05_heap\x94]\x94(h\x00\x8c\x04"
+        b"Node\x94\x93\x94\x8c\x01b\x94K\x01K\x01\x87\x94\x81\x94h\x0c\x8c\x01a"
+        b"\x94K\x03K\x03\x87\x94\x81\x94h\x0c\x8c\x01c\x94K\x02K\x02\x87\x94"
+        b"\x81\x94e\x8c\t_position\x94}\x94(h\x10K\x01h\rK\x00h\x13K\x02uub.",
+    ]
+    for data in legacy:
+        pq = pickle.loads(data)
+        _check_index(pq)
+        assert pq == {"a": 3, "b": 1, "c": 2}
+        assert pq.precedes is operator.lt
+        pq["d"] = 0
+        assert list(pq.popitems()) == [("d", 0), ("b", 1), ("c", 2), ("a", 3)]
+
+
+def test_iter_size_change():
+    # Like dict, iterating while adding or removing items raises
+    pq = pqdict(sample_items)
+    with pytest.raises(RuntimeError):
+        for key in pq:
+            pq[key + "_new"] = 0
+    pq = pqdict(sample_items)
+    with pytest.raises(RuntimeError):
+        for key in pq.keys():
+            del pq[key]
+    pq = pqdict(sample_items)
+    with pytest.raises(RuntimeError):
+        for _ in pq.items():
+            pq.popitem()
+    # Updating the priority of existing keys is allowed
+    pq = pqdict(sample_items)
+    for key in pq:
+        pq[key] = 0
+    assert set(pq.values()) == {0}
+    _check_index(pq)
+
+
+def test_pop_iterators_interleaved():
+    # The sorted iterators see items added or removed between steps
+    pq = pqdict.minpq(A=5, B=8, C=1)
+    it = pq.popitems()
+    assert next(it) == ("C", 1)
+    pq["D"] = 2
+    del pq["A"]
+    assert next(it) == ("D", 2)
+    _check_index(pq)
+    assert list(it) == [("B", 8)]
+    pq = pqdict.minpq(A=5, B=8, C=1)
+    it = pq.popkeys()
+    assert next(it) == "C"
+    pq.clear()
+    assert list(it) == []
+
+
 ####################
 # Priority Queue API
 ####################
@@ -348,6 +537,11 @@ def test_updateitem():
     # assign new value
     pq.updateitem(key, value + 1.0)
     assert pq[key] == value + 1.0
+    # assign a value with an equal priority key
+    pq = pqdict(sample_tuple_items, key=operator.itemgetter(1))
+    pq.updateitem("A", ("z", 5))
+    assert pq["A"] == ("z", 5)
+    _check_index(pq)
     # can only update existing keys
     with pytest.raises(KeyError):
         pq.updateitem("does_not_exist", 99.0)
@@ -356,11 +550,36 @@ def test_updateitem():
 def test_pushpopitem():
     pq = pqdict.minpq(A=5, B=8, C=1)
     assert pq.pushpopitem("D", 10) == ("C", 1)
+    _check_index(pq)
     assert pq.pushpopitem("E", 5) == ("E", 5)
+    _check_index(pq)
     with pytest.raises(KeyError):
         pq.pushpopitem("A", 99)
 
 
+def test_replaceitem():
+    pq = pqdict.minpq(A=5, B=8, C=1)
+    assert pq.replaceitem("D", 10) == ("C", 1)
+    _check_index(pq)
+    assert pq.replaceitem("E", 0) == ("A", 5)
+    _check_index(pq)
+    assert pq.top() == "E"
+    assert pq.replaceitem("E", 9) == ("E", 0)
+    _check_index(pq)
+    assert pq.topitem() == ("B", 8)
+    with pytest.raises(KeyError):
+        pq.replaceitem("D", 99)
+    # The top key may be replaced even if it does not compare equal to itself
+    nan = float("nan")
+    pq = pqdict({nan: 0, "b": 1})
+    assert pq.replaceitem(nan, 5) == (nan, 0)
+    assert pq.topitem() == ("b", 1)
+    assert pq[nan] == 5
+    pq = pqdict()
+    with pytest.raises(Empty):
+        pq.replaceitem("A", 1)
+
+
 def test_replace_key():
     pq = pqdict.minpq(A=5, B=8, C=1)
     pq.replace_key("A", "Alice")
@@ -412,7 +631,7 @@ def test_heapify():
         items = generate_data("int", size)
         pq = pqdict(items)
         _check_heap_invariant(pq)
-        assert len(pq._heap) == size
+        assert len(pq._keys) == size
         _check_index(pq)
 
 
@@ -436,7 +655,7 @@ def test_heapsort():
         _check_heap_invariant(pq)
         _check_index(pq)
         popped_items.append(key_value)
-    assert len(pq._heap) == 0
+    assert len(pq._keys) == 0
     _check_index(pq)
 
 
@@ -582,6 +801,77 @@ def test_repair():
     assert pq[pq.top()] == [1]
     pq.heapify("C")
     assert pq[pq.top()] == [0]
+    # reassigning a value mutated in place also repairs the heap
+    mutable_value[0] = 5
+    pq["C"] = mutable_value
+    assert pq[pq.top()] == [1]
+    _check_heap_invariant(pq)
+    # mutating in place, then assigning an equal copy, also repairs the heap
+    pq = pqdict.minpq(A=[1], B=[2], C=[0])
+    pq["C"][0] = 5
+    pq["C"] = [5]
+    assert list(pq.popkeys()) == ["A", "B", "C"]
+
+
+def test_update_ignores_eq():
+    # The heap never relies on == agreeing with precedes
+    class Event:
+        def __init__(self, tag, time):
+            self.tag = tag
+            self.time = time
+
+        def __eq__(self, other):
+            return self.tag == other.tag
+
+        def __ne__(self, other):
+            raise TypeError("ambiguous comparison")
+
+    def precedes(a, b):
+        return a.time < b.time
+
+    events = {"A": Event(0, 1), "B": Event(0, 2), "C": Event(0, 3)}
+    pq = pqdict(events, precedes=precedes)
+    pq["C"] = Event(0, 0)
+    assert pq.top() == "C"
+    pq.updateitem("C", Event(0, 5))
+    assert pq.top() == "A"
+    _check_index(pq)
+    assert list(pq.popkeys()) == ["A", "B", "C"]
+
+
+def test_heapify_all():
+    for precedes in (operator.lt, operator.gt, lambda x, y: x[0] < y[0]):
+        values = [[random.randrange(25)] for _ in range(50)]
+        pq = pqdict(enumerate(values), precedes=precedes)
+        for value in values:
+            value[0] = random.randrange(25)
+        pq.heapify()
+        _check_index(pq)
+        prios = pq._prios
+        for pos in range(1, len(prios)):
+            assert not precedes(prios[pos], prios[(pos - 1) >> 1])
+
+
+def test_heapify_eq_inconsistent_with_lt():
+    # Priorities that compare equal by tag but are ordered by time
+    @functools.total_ordering
+    class Event:
+        def __init__(self, tag, time):
+            self.tag = tag
+            self.time = time
+
+        def __eq__(self, other):
+            return self.tag == other.tag
+
+        def __lt__(self, other):
+            return self.time < other.time
+
+    rng = random.Random(42)
+    times = list(range(50))
+    rng.shuffle(times)
+    pq = pqdict((i, Event(i % 2, t)) for i, t in enumerate(times))
+    _check_index(pq)
+    assert [event.time for event in pq.popvalues()] == sorted(times)
 
 
 ########################
@@ -593,6 +883,10 @@ def test_nbest():
     assert list(top3) == ["F", "E", "B"]
     bot3 = nsmallest(3, dict(sample_items))
     assert list(bot3) == ["G", "D", "A"]
+    assert nlargest(10, {"A": 1, "B": 2}) == ["B", "A"]
+    assert nsmallest(10, {"A": 1, "B": 2}) == ["A", "B"]
+    assert nlargest(0, dict(sample_items)) == []
+    assert nsmallest(0, dict(sample_items)) == []
 
 
 def test_nbest_key():